@@ -1,11 +1,16 @@
-executable = baseline_inference.sh
-getenv     = true
-arguments  = --model_dir MODEL_DIR --data_dir DATA_DIR --output_dir OUTPUT_DIR
-transfer_input_files = baseline_inference.py,run_inference.sh,MODEL_DIR/,DATA_DIR/
-output         = logs/job_$(Cluster)_$(Process).out
-error          = logs/job_$(Cluster)_$(Process).err
-log            = logs/job_$(Cluster)_$(Process).log
-notification = complete
-transfer_executable = false
-request_memory = 4*1024
-queue
+# one job per shard; merge afterwards with merge_shards.py --output_dir OUTPUT_DIR
+NumShards  = 8
+Workers    = 4
+executable = baseline_inference.sh
+getenv     = true
+arguments  = --model_dir MODEL_DIR --data_dir DATA_DIR --output_dir OUTPUT_DIR --num_shards $(NumShards) --shard_index $(Process) --num_workers $(Workers) --torch_threads 1 --skip_manifest_update
+transfer_input_files = baseline_inference.py,scoring.py,embedding_cache.py,manifest.py,export_model.py,local_model.py,profiling.py,audio.py,run_inference.sh,MODEL_DIR/,DATA_DIR/
+output         = logs/job_$(Cluster)_$(Process).out
+error          = logs/job_$(Cluster)_$(Process).err
+log            = logs/job_$(Cluster)_$(Process).log
+notification = complete
+transfer_executable = false
+request_cpus = $(Workers)
+# MB: ~0.5 GB for the main process plus ~1.1 GB per worker (~1.3 GB with --batch_size > 1)
+request_memory = 1024 + 1536 * $(Workers)
+queue $(NumShards)
@@ -0,0 +1,20 @@
+import functools
+
+import torch
+import torchaudio
+
+# the VoxLingua107 ECAPA model takes 16 kHz mono
+SAMPLE_RATE = 16000
+
+
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_freq, new_freq=SAMPLE_RATE):
+    # the sinc kernel is built once per rate pair and reused for every file in this process
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+
+def set_worker_threads(torch_threads=1):
+    # parallelism comes from the worker processes, so each gets few intra-op threads;
+    # None/0 keeps torch's default
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
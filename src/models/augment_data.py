@@ -1,50 +1,224 @@
-
 import os
+import json
+import sqlite3
+import argparse
+import multiprocessing as mp
+
 import torchaudio
-from torchaudio import transforms as T
+
+from audio import get_resampler, set_worker_threads
+from embedding_cache import hash_file
+from manifest import get_records
 
 INPUT_DIR = os.environ.get("INPUT_DIR", "/gscratch/stf/abimaelh/Shiro_Corpus_Segments")
 OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "/gscratch/stf/abimaelh/Shiro_Corpus_Segments_Augmented")
+MANIFEST = os.environ.get("MANIFEST")
 
 SPEED_FACTORS = [0.9, 1.1]
 PITCH_SHIFTS = [-100, 100]
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# bump when the way variants are produced changes, so old outputs are redone.
+# 1: speed variants are real tempo/pitch changes saved at the source rate (the original script
+# saved them at sr * speed, which plays back unchanged); trees it wrote have no recipe rows
+RECIPE_VERSION = 1
 
-for subject in os.listdir(INPUT_DIR):
-    subject_path = os.path.join(INPUT_DIR, subject)
-    if not os.path.isdir(subject_path):
-        continue
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    source_path TEXT NOT NULL,
+    source_sha1 TEXT NOT NULL,
+    speed REAL,
+    pitch INTEGER,
+    recipe TEXT NOT NULL
+);
+"""
 
-    out_subject_path = os.path.join(OUTPUT_DIR, subject)
-    os.makedirs(out_subject_path, exist_ok=True)
 
-    for file_name in os.listdir(subject_path):
-        if not file_name.endswith(".wav"):
-            continue
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write speed/pitch perturbed copies of every segment.")
+    parser.add_argument("--input_dir", default=INPUT_DIR)
+    parser.add_argument("--output_dir", default=OUTPUT_DIR)
+    parser.add_argument("--manifest", default=MANIFEST,
+                        help="segment index of the input tree (default: INPUT_DIR/manifest.sqlite)")
+    parser.add_argument("--speed_factors", type=float, nargs="*", default=SPEED_FACTORS)
+    parser.add_argument("--pitch_shifts", type=int, nargs="*", default=PITCH_SHIFTS,
+                        help="pitch shifts in cents, applied to each speed variant")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true", help="rewrite outputs even if their recipe is unchanged")
+    parser.add_argument("--prune_stale", action="store_true",
+                        help="delete outputs whose source or variant is gone (default: only list them)")
+    return parser.parse_args()
+
+
+def variant_grid(speed_factors, pitch_shifts):
+    # orig, one file per speed, one per speed x pitch (7 files with the defaults)
+    variants = [(None, None)]
+    for speed in speed_factors:
+        variants.append((speed, None))
+        variants.extend((speed, pitch) for pitch in pitch_shifts)
+    return variants
+
+
+def variant_name(base_name, speed, pitch):
+    if speed is None:
+        return base_name + "_orig.wav"
+    if pitch is None:
+        return f"{base_name}_speed{speed}.wav"
+    return f"{base_name}_speed{speed}_pitch{pitch:+d}.wav"
+
+
+def recipe_for(source_sha1, speed, pitch):
+    return json.dumps({"version": RECIPE_VERSION, "source_sha1": source_sha1, "speed": speed, "pitch": pitch},
+                      sort_keys=True)
+
+
+def speed_perturb(waveform, sample_rate, speed):
+    # treat the audio as recorded at sr * speed and resample it back to sr: 0.9 plays slower
+    # and lower, 1.1 faster and higher. int(sr * speed) keeps the rate pair (and kernel) small
+    return get_resampler(int(sample_rate * speed), sample_rate)(waveform)
+
+
+def pitch_shift(waveform, sample_rate, pitch):
+    shifted, _ = torchaudio.sox_effects.apply_effects_tensor(waveform, sample_rate, [["pitch", str(pitch)]])
+    return shifted
 
-        in_file_path = os.path.join(subject_path, file_name)
+
+def augment_file(job):
+    """Writes the requested variants of one source file; returns (written, errors)."""
+    in_file_path, out_dir, variants = job
+    file_name = os.path.basename(in_file_path)
+    written, errors = [], []
+    try:
         waveform, sample_rate = torchaudio.load(in_file_path)
+    except Exception as e:
+        return written, [f"Error loading {file_name}: {e}"]
+
+    os.makedirs(out_dir, exist_ok=True)
+    speed_cache = {}
+    for speed, pitch, out_name in variants:
+        try:
+            if speed is None:
+                augmented = waveform
+            else:
+                if speed not in speed_cache:
+                    speed_cache[speed] = speed_perturb(waveform, sample_rate, speed)
+                augmented = speed_cache[speed]
+                if pitch is not None:
+                    augmented = pitch_shift(augmented, sample_rate, pitch)
+            torchaudio.save(os.path.join(out_dir, out_name), augmented, sample_rate)
+            written.append(out_name)
+        except Exception as e:
+            errors.append(f"Error processing {file_name} with speed={speed}, pitch={pitch}: {e}")
+    return written, errors
+
+
+def source_hashes(conn, records):
+    # only rehash sources whose size or mtime changed since the last run. stat the file itself:
+    # the manifest's values can be stale, since an in-place rewrite leaves the directory mtime alone
+    known = {path: (size, mtime_ns, sha1) for path, size, mtime_ns, sha1 in
+             conn.execute("SELECT path, size, mtime_ns, sha1 FROM sources")}
+    hashes = {}
+    for record in records:
+        try:
+            stat = os.stat(record["path"])
+        except OSError as e:
+            print(f"Skipping {record['path']}: {e}")
+            continue
+        known_row = known.get(record["path"])
+        if known_row is not None and known_row[:2] == (stat.st_size, stat.st_mtime_ns):
+            hashes[record["path"]] = known_row[2]
+            continue
+        sha1 = hash_file(record["path"])
+        conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                     (record["path"], stat.st_size, stat.st_mtime_ns, sha1))
+        hashes[record["path"]] = sha1
+    conn.commit()
+    return hashes
+
+
+def remove_stale(conn, output_dir, expected, prune):
+    """Lists recorded outputs that no current source/variant would write; deletes them with prune."""
+    stale = [path for (path,) in conn.execute("SELECT path FROM outputs") if path not in expected]
+    if not stale:
+        return
+    if not prune:
+        print(f"{len(stale)} outputs no longer match a source file or variant (kept; --prune_stale deletes them):")
+        for path in stale:
+            print(f"  {path}")
+        return
+    for path in stale:
+        try:
+            os.remove(os.path.join(output_dir, path))
+        except FileNotFoundError:
+            pass
+    conn.executemany("DELETE FROM outputs WHERE path = ?", [(path,) for path in stale])
+    conn.commit()
+    print(f"Removed {len(stale)} outputs that no longer match a source file or variant")
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(args.output_dir, "augment_manifest.sqlite"), timeout=60)
+    conn.executescript(SCHEMA)
+
+    records = get_records(args.input_dir, args.manifest)
+    hashes = source_hashes(conn, records)
+    done = dict(conn.execute("SELECT path, recipe FROM outputs"))
+    variants = variant_grid(args.speed_factors, args.pitch_shifts)
+
+    # one job per source file, holding only the variants that are missing or stale
+    jobs, job_dirs, pending_recipes, expected = [], [], {}, set()
+    for record in records:
+        in_file_path = record["path"]
+        # mirror the input layout, e.g. <subject>/<file>.wav
+        rel_dir = os.path.dirname(os.path.relpath(in_file_path, args.input_dir))
+        out_dir = os.path.join(args.output_dir, rel_dir)
+        base_name = os.path.splitext(os.path.basename(in_file_path))[0]
+        # a source that could not be stat'ed this run is still in the manifest: keep its outputs
+        expected.update(os.path.join(rel_dir, variant_name(base_name, speed, pitch)) for speed, pitch in variants)
+        if in_file_path not in hashes:
+            continue
 
-        base_name = os.path.splitext(file_name)[0]
+        todo = []
+        for speed, pitch in variants:
+            out_name = variant_name(base_name, speed, pitch)
+            out_rel = os.path.join(rel_dir, out_name)
+            recipe = recipe_for(hashes[in_file_path], speed, pitch)
+            if (not args.force and done.get(out_rel) == recipe
+                    and os.path.exists(os.path.join(args.output_dir, out_rel))):
+                continue
+            todo.append((speed, pitch, out_name))
+            pending_recipes[out_rel] = (in_file_path, hashes[in_file_path], speed, pitch, recipe)
+        if todo:
+            jobs.append((in_file_path, out_dir, todo))
+            job_dirs.append(rel_dir)
+    remove_stale(conn, args.output_dir, expected, args.prune_stale)
 
-        torchaudio.save(os.path.join(out_subject_path, base_name + "_orig.wav"), waveform, sample_rate)
+    print(f"{len(hashes)} source files, {len(pending_recipes)} outputs to write, "
+          f"{len(hashes) * len(variants) - len(pending_recipes)} up to date")
+    if not jobs:
+        return
 
-        for speed in SPEED_FACTORS:
-            new_sample_rate = int(sample_rate * speed)
-            resampled = T.Resample(orig_freq=sample_rate, new_freq=new_sample_rate)(waveform)
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(max(1, args.num_workers), initializer=set_worker_threads) as pool:
+        for rel_dir, (written, errors) in zip(job_dirs, pool.imap(augment_file, jobs)):
+            for message in errors:
+                print(message)
+            rows = []
+            for out_name in written:
+                out_rel = os.path.join(rel_dir, out_name)
+                rows.append((out_rel,) + pending_recipes[out_rel])
+            conn.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.commit()
+    conn.close()
 
-            speed_tag = f"speed{speed}"
-            file_speed = f"{base_name}_{speed_tag}.wav"
-            torchaudio.save(os.path.join(out_subject_path, file_speed), resampled, new_sample_rate)
 
-            for pitch in PITCH_SHIFTS:
-                pitch_str = f"pitch{pitch:+d}"
-                effects = [["pitch", str(pitch)]]
-                try:
-                    shifted_waveform, _ = torchaudio.sox_effects.apply_effects_tensor(resampled, new_sample_rate, effects)
-                    file_aug = f"{base_name}_{speed_tag}_{pitch_str}.wav"
-                    out_path = os.path.join(out_subject_path, file_aug)
-                    torchaudio.save(out_path, shifted_waveform, new_sample_rate)
-                except Exception as e:
-                    print(f"Error processing {file_name} with speed={speed}, pitch={pitch}: {e}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,129 +1,410 @@
 import os
+import csv
+import sys
+import json
+import time
 import argparse
+import multiprocessing as mp
+
+# taken before torch is imported, for --profile_startup
+_START = time.perf_counter()
+
+import torch
 import torchaudio
-import pandas as pd
-from speechbrain.inference.classifiers import EncoderClassifier
-from collections import defaultdict
-from pathlib import Path
-from glob import glob
-from sklearn.metrics import precision_recall_fscore_support
-
-# condor args
-parser = argparse.ArgumentParser()
-parser.add_argument("--model_dir", required=True)
-parser.add_argument("--data_dir", required=True)
-parser.add_argument("--output_dir", required=True)
-args = parser.parse_args()
-
-# Ensure output directory exists
-os.makedirs(args.output_dir, exist_ok=True)
-
-MODEL_DIR = args.model_dir
-DATA_DIR = args.data_dir
-OUTPUT_DIR = args.output_dir
-
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-# load voxlingua107
-language_id = EncoderClassifier.from_hparams(
-    source="speechbrain/lang-id-voxlingua107-ecapa",
-    savedir=MODEL_DIR
-)
-
-# initialize result lists
-predictions = []
-subject_correct_counts = defaultdict(int)
-subject_total_counts = defaultdict(int)
-
-# find all .wav files in nested subdirectories
-wav_files = glob(f"{DATA_DIR}/**/*.wav", recursive=True)
-if not wav_files:
-    raise ValueError("No .wav files found in DATA_DIR. Check the folder structure.")
-
-# run inference
-for file_path in wav_files:
-    if "archive" in file_path.lower():
-        continue
+
+# pandas, sklearn and speechbrain are imported only by the steps that need them, so a job
+# that reads the cache or runs a TorchScript export never pays for them before predicting
+from audio import SAMPLE_RATE, get_resampler, set_worker_threads
+from embedding_cache import EmbeddingCache, hash_file, hash_model, label_encoder_path
+from export_model import load_exported
+from manifest import get_records
+from profiling import current_rss_mb, latency_percentiles, peak_rss_mb, timed
+from scoring import prediction_row, write_outputs
+
+_model = None
+_model_dir = None
+_exported_path = None
+_exported_model = None
+# per-process stage totals for --profile_stages; None when profiling is off
+_stage_seconds = None
+_startup = {}
+_startup_modules = None
+HEAVY_MODULES = ["pandas", "sklearn", "speechbrain", "hyperpyyaml"]
+
+
+def parse_args():
+    # condor args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", required=True)
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--manifest", default=None,
+                        help="segment index to read/update (default: DATA_DIR/manifest.sqlite)")
+    parser.add_argument("--skip_manifest_update", action="store_true",
+                        help="trust an existing manifest as-is instead of re-stating changed directories")
+    parser.add_argument("--backend", choices=["speechbrain", "exported"], default="speechbrain",
+                        help="stock fp32 EncoderClassifier, or a file written by export_model.py")
+    parser.add_argument("--exported_model", default=None,
+                        help="exported model file for --backend exported")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="segments per forward pass; >1 groups segments of similar duration into padded batches "
+                             "(not faster for 2-3 s segments on CPU, and padding changes scores)")
+    parser.add_argument("--max_batch_seconds", type=float, default=8.0,
+                        help="padded audio per batch (longest segment x batch length); longer segments run alone")
+    parser.add_argument("--max_duration_spread", type=float, default=1.25,
+                        help="start a new batch once the longest segment is this many times the shortest")
+    parser.add_argument("--cache_dir", default=None,
+                        help="reuse cached embeddings/log-posteriors keyed by audio and model hash")
+    parser.add_argument("--num_shards", type=int, default=1,
+                        help="split subjects into this many independent jobs; merge with merge_shards.py")
+    parser.add_argument("--shard_index", type=int, default=0)
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="local worker processes, each with its own copy of the model")
+    parser.add_argument("--torch_threads", type=int, default=None,
+                        help="intra-op threads per worker (default: cores / num_workers)")
+    parser.add_argument("--profile_startup", "--profile-startup", action="store_true",
+                        help="report time to each startup stage and to the first prediction")
+    parser.add_argument("--profile_stages", "--profile-stages", action="store_true",
+                        help="time decode/resample/fbank/embedding/classifier/postprocess and track RSS; "
+                             "writes stage_profile.json next to the predictions")
+    return parser.parse_args()
+
+
+def mark_startup(stage):
+    # seconds since the interpreter reached this module; only the first mark of a stage counts
+    global _startup_modules
+    if stage not in _startup:
+        _startup[stage] = time.perf_counter() - _START
+    if stage in ("first_prediction", "all_predictions") and _startup_modules is None:
+        # all_predictions covers runs served entirely from the cache
+        _startup_modules = [m for m in HEAVY_MODULES if m in sys.modules]
+
+
+def write_startup_profile(path):
+    report = {"seconds": _startup, "heavy_modules_before_predicting": _startup_modules}
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print("\n=== Startup profile (seconds since start) ===")
+    for stage, seconds in _startup.items():
+        print(f"{stage:<20}{seconds:8.2f}")
+    print(f"Heavy modules imported before predicting: {', '.join(_startup_modules or []) or 'none'}")
+    print(f"Saved startup profile to: {path}")
+
+
+def write_stage_profile(path, report):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print("\n=== Stage profile ===")
+    stages = {**report["stages"], **report["model_stages"]}
+    for stage, seconds in stages.items():
+        print(f"{stage:<20}{seconds:8.2f}s")
+    latency = report["latency_ms"]
+    if latency:
+        print(f"Per-file latency: p50 {latency['p50']:.0f} ms, p90 {latency['p90']:.0f} ms, "
+              f"p99 {latency['p99']:.0f} ms")
+    print(f"{report['files_per_second']:.2f} files/s; peak RSS {report['rss_mb']['peak_main']:.0f} MB")
+    print(f"Saved stage profile to: {path}")
+
+
+def init_worker(model_dir, torch_threads, exported_path=None, profile_stages=False):
+    global _model_dir, _exported_path, _stage_seconds
+    _model_dir = model_dir
+    _exported_path = exported_path
+    _stage_seconds = {} if profile_stages else None
+    set_worker_threads(torch_threads)
+
+
+def get_model():
+    # load voxlingua107 only once something actually needs the forward pass,
+    # from the files shipped in MODEL_DIR (no hub lookups)
+    global _model
+    if _model is None:
+        with timed(_stage_seconds, "model_load"):
+            from local_model import load_local_model
+            _model = load_local_model(_model_dir)
+        mark_startup("model_load")
+    return _model
+
+
+def get_exported_model():
+    global _exported_model
+    if _exported_model is None:
+        with timed(_stage_seconds, "model_load"):
+            _exported_model = load_exported(_exported_path)
+        mark_startup("model_load")
+    return _exported_model
+
+
+def model_labels():
+    if _exported_path is not None:
+        return get_exported_model().labels
+    if _model is not None:
+        label_encoder = _model.hparams.label_encoder
+    else:
+        # workers did the forward passes; read the labels without loading weights
+        from speechbrain.dataio.encoder import CategoricalEncoder
+        label_encoder = CategoricalEncoder()
+        label_encoder.load(label_encoder_path(_model_dir))
+    return [label_encoder.ind2lab[i] for i in range(len(label_encoder))]
+
+
+def shard_records(records, num_shards, shard_index):
+    # whole subjects go to one shard so per-subject stats never straddle jobs;
+    # biggest subjects first onto the least loaded shard keeps shard durations even
+    subject_durations = {}
+    for record in records:
+        key = (record["corpus"], record["subject"])
+        subject_durations[key] = subject_durations.get(key, 0.0) + (record["duration"] or 0.0)
+
+    shard_loads = [0.0] * num_shards
+    subject_shard = {}
+    for key, duration in sorted(subject_durations.items(), key=lambda kv: (-kv[1], kv[0])):
+        shard = min(range(num_shards), key=lambda i: shard_loads[i])
+        subject_shard[key] = shard
+        shard_loads[shard] += duration
+    return [r for r in records if subject_shard[(r["corpus"], r["subject"])] == shard_index]
+
+
+def load_signal(file_path):
+    # decode once, then resample/downmix exactly like speechbrain's AudioNormalizer in classify_file
+    with timed(_stage_seconds, "decode"):
+        signal, fs = torchaudio.load(file_path, channels_first=False)
+    with timed(_stage_seconds, "resample"):
+        if fs != SAMPLE_RATE:
+            signal = get_resampler(fs)(signal.transpose(0, 1)).transpose(0, 1)
+        return signal.mean(dim=1)
+
+
+def make_batches(records, batch_size, max_batch_seconds=8.0, max_duration_spread=1.25):
+    if batch_size <= 1:
+        return [[r["path"]] for r in records]
+    # sort by indexed duration, then close a batch when it is full, when padding every segment to the
+    # newest (longest) one would pass the audio budget, or when lengths drift too far apart. on CPU
+    # batching only pays off for short segments; long ones get slower per file and cost memory
+    ordered = sorted(records, key=lambda r: r["duration"] or 0.0)
+    batches, batch, shortest = [], [], 0.0
+    for r in ordered:
+        duration = r["duration"]
+        if batch and (len(batch) == batch_size or duration is None
+                      or duration * (len(batch) + 1) > max_batch_seconds
+                      or duration > shortest * max_duration_spread):
+            batches.append(batch)
+            batch = []
+        if not batch:
+            shortest = duration or 0.0
+        batch.append(r["path"])
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def classify_signals(signals):
+    # same steps as classify_batch, but keep the embeddings and full posteriors
+    lengths = torch.tensor([s.shape[0] for s in signals], dtype=torch.float)
+    wavs = torch.nn.utils.rnn.pad_sequence(signals, batch_first=True)
+    wav_lens = lengths / lengths.max()
+    if _exported_path is not None:
+        model = get_exported_model()
+        # one fused module: fbank, embedding and classifier are not separable here
+        with timed(_stage_seconds, "exported_model"):
+            return model(wavs, wav_lens)
+    model = get_model()
+    with torch.no_grad():
+        # the steps of encode_batch, split so each can be timed
+        with timed(_stage_seconds, "fbank"):
+            feats = model.mods.compute_features(wavs)
+        with timed(_stage_seconds, "embedding"):
+            feats = model.mods.mean_var_norm(feats, wav_lens)
+            embeddings = model.mods.embedding_model(feats, wav_lens)
+        with timed(_stage_seconds, "classifier"):
+            out_prob = model.mods.classifier(embeddings).squeeze(1)
+    return embeddings.squeeze(1), out_prob
+
+
+def classify_batch_files(batch):
+    """Runs one batch of files; returns [(file_path, embedding, log_probs)] and error messages."""
+    batch_files, signals, errors = [], [], []
+    for file_path in batch:
+        try:
+            signals.append(load_signal(file_path))
+            batch_files.append(file_path)
+        except Exception as e:
+            errors.append(f"Failed to process {file_path}: {e}")
+    if not signals:
+        return [], errors
     try:
-        signal, fs = torchaudio.load(file_path)
-        prediction = language_id.classify_file(file_path)
-        predicted_lang = prediction[3]
-        if isinstance(predicted_lang, list):
-            predicted_lang = predicted_lang[0]
+        embeddings, out_prob = classify_signals(signals)
     except Exception as e:
-        print(f"Failed to process {file_path}: {e}")
-        continue
-
-    subject_id = Path(file_path).parts[-2]
-    corpus = Path(file_path).parts[-4] if "cslu_segments" in file_path else "shiro"
-    true_lang = "spanish" if corpus == "shiro" else "english"
-
-    predictions.append({
-        "filename": subject_id,
-        "file_path": file_path,
-        "predicted_lang": predicted_lang,
-        "true_lang": true_lang,
-        "corpus": corpus
-    })
-
-    subject_total_counts[(corpus, subject_id)] += 1
-    predicted_lang_clean = predicted_lang.split(":", 1)[-1].strip().lower()
-    if predicted_lang_clean == true_lang.lower():
-        subject_correct_counts[(corpus, subject_id)] += 1
-
-# save predictions
-pred_df = pd.DataFrame(predictions)
-if pred_df.empty:
-    raise ValueError("Prediction dataframe is empty. No predictions were made.")
-
-pred_df["filename"] = pred_df["filename"].str.lower()
-pred_df.to_csv(os.path.join(OUTPUT_DIR, "predictions.csv"), index=False)
-
-# corpus accuracy
-for corpus_name in pred_df["corpus"].unique():
-    corpus_df = pred_df[pred_df["corpus"] == corpus_name]
-    print(f"\n=== Results for {corpus_name.upper()} ===")
-
-    subject_correct_counts = defaultdict(int)
-    subject_total_counts = defaultdict(int)
-
-    for _, row in corpus_df.iterrows():
-        subject_id = row["filename"]
-        predicted_lang = row["predicted_lang"]
-        true_lang = row["true_lang"]
-        corpus = row["corpus"]
-
-        subject_total_counts[(corpus, subject_id)] += 1
-        predicted_lang_clean = predicted_lang.split(":", 1)[-1].strip().lower()
-        if predicted_lang_clean == true_lang.lower():
-            subject_correct_counts[(corpus, subject_id)] += 1
-
-    subject_acc = []
-    for subject in corpus_df["filename"].unique():
-        key = (corpus_name, subject)
-        correct = subject_correct_counts.get(key, 0)
-        total = subject_total_counts.get(key, 0)
-        acc = correct / total if total > 0 else 0
-        subject_acc.append({"filename": subject, "accuracy": acc})
-
-    subject_acc_df = pd.DataFrame(subject_acc)
-    mean_acc = subject_acc_df["accuracy"].mean()
-    std_acc = subject_acc_df["accuracy"].std()
-
-    subject_acc_df.to_csv(os.path.join(OUTPUT_DIR, f"per_subject_accuracy_{corpus_name}.csv"), index=False)
-
-    corpus_df["predicted_lang_clean"] = corpus_df["predicted_lang"].apply(
-        lambda x: x.split(":", 1)[-1].strip().lower() if isinstance(x, str) else x)
-    overall_acc = (corpus_df["predicted_lang_clean"] == corpus_df["true_lang"].str.lower()).mean()
-    y_true = corpus_df["true_lang"].str.lower()
-    y_pred = corpus_df["predicted_lang_clean"]
-    precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, average="macro", zero_division=0)
-
-    print(f"Overall Accuracy: {overall_acc:.2%}")
-    print(f"Mean Per-Subject Accuracy: {mean_acc:.2%} ± {std_acc:.2%}")
-    print(f"Precision: {precision:.4f}, Recall: {recall:.4f}, F1: {f1:.4f}")
-
-pred_df["predicted_lang_clean"] = pred_df["predicted_lang"].str.extract(r":\s*(.*)").str.lower().str.strip()
-mismatches = pred_df[pred_df["predicted_lang_clean"] != pred_df["true_lang"].str.lower()]
-mismatches.to_csv(os.path.join(OUTPUT_DIR, "mismatched_predictions.csv"), index=False)
-print(f"Saved predictions to: {os.path.join(args.output_dir, 'predictions.csv')}")
\ No newline at end of file
+        return [], errors + [f"Failed to process {file_path}: {e}" for file_path in batch_files]
+    return [(f, embeddings[i].numpy(), out_prob[i].numpy()) for i, f in enumerate(batch_files)], errors
+
+
+def run_batch(batch):
+    # classify_batch_files plus, with --profile_stages, what the batch cost in this process
+    start = time.perf_counter()
+    batch_results, errors = classify_batch_files(batch)
+    if _stage_seconds is None:
+        return batch_results, errors, None
+    profile = {"seconds": time.perf_counter() - start, "files": len(batch), "stages": dict(_stage_seconds),
+               "rss_mb": current_rss_mb()}
+    _stage_seconds.clear()
+    return batch_results, errors, profile
+
+
+def run_batches(batches, args):
+    if args.num_workers <= 1:
+        yield from map(run_batch, batches)
+        return
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(args.num_workers, initializer=init_worker,
+                  initargs=(args.model_dir, args.torch_threads, args.exported_model, args.profile_stages)) as pool:
+        yield from pool.imap(run_batch, batches)
+
+
+def main():
+    args = parse_args()
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError("--shard_index must be in [0, --num_shards).")
+    if args.backend == "exported" and not args.exported_model:
+        raise ValueError("--backend exported needs --exported_model.")
+    if args.backend == "speechbrain":
+        args.exported_model = None
+    if args.num_workers > 1 and args.torch_threads is None:
+        args.torch_threads = max(1, (os.cpu_count() or 1) // args.num_workers)
+
+    # Ensure output directory exists
+    os.makedirs(args.output_dir, exist_ok=True)
+    mark_startup("imports")
+    init_worker(args.model_dir, args.torch_threads, args.exported_model, args.profile_stages)
+    # main-process stages; the per-batch model stages come back from run_batch
+    stages = {} if args.profile_stages else None
+    rss = {}
+
+    # all .wav files under DATA_DIR, from the incremental index
+    with timed(stages, "manifest"):
+        records = get_records(args.data_dir, args.manifest, update=not args.skip_manifest_update)
+    file_index = {r["path"]: i for i, r in enumerate(records)}
+    if args.num_shards > 1:
+        records = shard_records(records, args.num_shards, args.shard_index)
+        print(f"Shard {args.shard_index}/{args.num_shards}: {len(records)} files")
+    mark_startup("manifest")
+    rss["after_manifest"] = current_rss_mb()
+
+    # look up cached outputs before touching the model
+    cache = None
+    audio_hashes = {}
+    results = {}
+    if args.cache_dir:
+        # an export gives (slightly) different outputs, so it gets its own cache key
+        model_hash = hash_file(args.exported_model) if args.exported_model else hash_model(args.model_dir)
+        cache = EmbeddingCache(args.cache_dir, model_hash)
+        with timed(stages, "cache_lookup"):
+            for record in records:
+                file_path = record["path"]
+                try:
+                    audio_hashes[file_path] = hash_file(file_path)
+                except OSError as e:
+                    print(f"Failed to process {file_path}: {e}")
+                    continue
+                cached = cache.get(audio_hashes[file_path])
+                if cached is not None:
+                    results[file_path] = cached[1]
+        print(f"Cache hits: {len(results)}/{len(records)}")
+        mark_startup("cache_lookup")
+
+    # run inference
+    pending = [r for r in records if r["path"] not in results and (cache is None or r["path"] in audio_hashes)]
+    batches = make_batches(pending, args.batch_size, args.max_batch_seconds, args.max_duration_spread)
+    model_stages, latencies, worker_rss = {}, [], []
+    inference_start = time.perf_counter()
+    for batch_results, errors, profile in run_batches(batches, args):
+        for message in errors:
+            print(message)
+        for file_path, embedding, log_probs in batch_results:
+            mark_startup("first_prediction")
+            results[file_path] = log_probs
+            if cache is not None:
+                cache.put(audio_hashes[file_path], embedding, log_probs)
+        if profile is not None:
+            # summed over workers, so model stages can add up to more than the inference wall time
+            for stage, seconds in profile["stages"].items():
+                model_stages[stage] = model_stages.get(stage, 0.0) + seconds
+            # every file in a batch waits for the whole batch
+            latencies.extend([profile["seconds"]] * profile["files"])
+            worker_rss.append(profile["rss_mb"])
+    inference_seconds = time.perf_counter() - inference_start
+    if stages is not None:
+        stages["inference"] = inference_seconds
+        rss["after_inference"] = current_rss_mb()
+
+    postprocess_start = time.perf_counter()
+    labels = None
+    if cache is not None:
+        labels = cache.labels
+    if pending or labels is None:
+        labels = model_labels()
+        if cache is not None:
+            cache.save_labels(labels)
+
+    # keep the original file order in every output regardless of batching
+    predictions = []
+    for record in records:
+        if record["path"] not in results:
+            continue
+        predicted_lang = labels[int(results[record["path"]].argmax())]
+        predictions.append(prediction_row(record, predicted_lang))
+
+    mark_startup("all_predictions")
+
+    def finish(profile_dir, suffix=""):
+        if args.profile_startup:
+            write_startup_profile(os.path.join(profile_dir, f"startup_profile{suffix}.json"))
+        if stages is None:
+            return
+        stages["postprocess"] = time.perf_counter() - postprocess_start
+        rss["after_postprocess"] = current_rss_mb()
+        rss["peak_main"] = peak_rss_mb()
+        if args.num_workers > 1:
+            # the pool has been joined, so its workers count as finished children
+            rss["peak_worker"] = peak_rss_mb(children=True)
+            rss["max_sampled_worker"] = max((r for r in worker_rss if r is not None), default=None)
+        write_stage_profile(os.path.join(profile_dir, f"stage_profile{suffix}.json"), {
+            "files": len(records),
+            "predicted": len(predictions),
+            "from_cache": len(records) - len(pending),
+            "batches": len(batches),
+            "settings": {"backend": args.backend, "batch_size": args.batch_size,
+                         "max_batch_seconds": args.max_batch_seconds, "num_workers": args.num_workers,
+                         "torch_threads": args.torch_threads or torch.get_num_threads(),
+                         "cache": bool(args.cache_dir)},
+            "wall_seconds": time.perf_counter() - _START,
+            "files_per_second": len(pending) / inference_seconds if pending and inference_seconds else 0.0,
+            "stages": stages,
+            "model_stages": model_stages,
+            "latency_ms": latency_percentiles(latencies),
+            "rss_mb": rss,
+        })
+
+    if args.num_shards > 1:
+        # scoring happens once all shards are in, see merge_shards.py
+        shard_dir = os.path.join(args.output_dir, "shards")
+        os.makedirs(shard_dir, exist_ok=True)
+        shard_path = os.path.join(shard_dir, f"predictions_{args.shard_index:03d}_of_{args.num_shards:03d}.csv")
+        # csv rather than pandas, so shard jobs never import it
+        with open(shard_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, ["file_index", "filename", "file_path", "predicted_lang", "true_lang", "corpus"])
+            writer.writeheader()
+            for row in predictions:
+                writer.writerow({"file_index": file_index[row["file_path"]], **row})
+        print(f"Saved shard predictions to: {shard_path}")
+        mark_startup("outputs_written")
+        finish(shard_dir, f"_{args.shard_index:03d}_of_{args.num_shards:03d}")
+        return
+
+    write_outputs(predictions, args.output_dir)
+    mark_startup("outputs_written")
+    finish(args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+import torch
+import torchaudio
+
+from embedding_cache import hash_model
+from profiling import maxrss_mb
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# mode -> extra baseline_inference.py arguments; {batch_size}, {num_workers}, {cache_dir}
+# and {int8_model}/{int8_ts_model} are filled in from the benchmark settings
+MODES = {
+    "baseline": [],
+    "batched": ["--batch_size", "{batch_size}"],
+    "workers": ["--batch_size", "{batch_size}", "--num_workers", "{num_workers}"],
+    "cache_cold": ["--batch_size", "{batch_size}", "--cache_dir", "{cache_dir}"],
+    "cache_warm": ["--batch_size", "{batch_size}", "--cache_dir", "{cache_dir}"],
+    "int8": ["--batch_size", "{batch_size}", "--backend", "exported", "--exported_model", "{int8_model}"],
+    "int8_torchscript": ["--backend", "exported", "--exported_model", "{int8_ts_model}"],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark baseline_inference.py on a synthetic segment tree.")
+    parser.add_argument("--model_dir", required=True)
+    parser.add_argument("--work_dir", default="benchmark", help="synthetic data, exports and per-mode outputs")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--subjects", type=int, default=10, help="subjects per corpus")
+    parser.add_argument("--mean_duration", type=float, default=2.5,
+                        help="segment durations are log-normal around this many seconds")
+    parser.add_argument("--duration_sigma", type=float, default=0.6)
+    parser.add_argument("--min_duration", type=float, default=0.3)
+    parser.add_argument("--max_duration", type=float, default=15.0)
+    parser.add_argument("--sample_rates", type=int, nargs="+", default=[16000, 44100],
+                        help="each file gets one of these at random")
+    parser.add_argument("--stereo_fraction", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_workers", type=int, default=max(2, (os.cpu_count() or 1) // 2))
+    parser.add_argument("--compare", default=None, help="an earlier benchmark.json to report changes against")
+    return parser.parse_args()
+
+
+def tree_settings(args):
+    return {k: getattr(args, k) for k in ("files", "subjects", "mean_duration", "duration_sigma", "min_duration",
+                                          "max_duration", "sample_rates", "stereo_fraction", "seed")}
+
+
+def synthetic_segment(rng, duration, sample_rate, channels):
+    # voiced-sounding noise: a child-range f0 with a few harmonics, syllable-rate envelope, background hiss
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    f0 = rng.uniform(200, 350) * (1 + 0.05 * np.sin(2 * np.pi * rng.uniform(0.5, 2) * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * rng.uniform(3, 5) * t + rng.uniform(0, 2 * np.pi)))
+    signal = 0.1 * voiced * envelope + 0.01 * rng.standard_normal(t.shape[0])
+    signal = np.tile(signal, (channels, 1)) + 0.002 * rng.standard_normal((channels, t.shape[0]))
+    return torch.from_numpy(signal.astype(np.float32))
+
+
+def generate_tree(data_dir, settings):
+    """Writes a CSLU/Shiro-shaped tree: cslu_segments/<grade>/<batch>/<subject>/*.wav and
+    shiro_segments/<subject>_segments/*.wav, half the files in each."""
+    rng = np.random.default_rng(settings["seed"])
+    for i in range(settings["files"]):
+        subject = (i // 2) % settings["subjects"]
+        if i % 2 == 0:
+            subject_id = f"ks{subject:03d}xx0"
+            out_dir = os.path.join(data_dir, "cslu_segments", f"{subject % 3:02d}", "1", subject_id)
+        else:
+            subject_id = f"{subject}_rom{subject}"
+            out_dir = os.path.join(data_dir, "shiro_segments", f"{subject_id}_segments")
+        duration = float(np.clip(rng.lognormal(np.log(settings["mean_duration"]), settings["duration_sigma"]),
+                                 settings["min_duration"], settings["max_duration"]))
+        sample_rate = int(rng.choice(settings["sample_rates"]))
+        channels = 2 if rng.random() < settings["stereo_fraction"] else 1
+        os.makedirs(out_dir, exist_ok=True)
+        torchaudio.save(os.path.join(out_dir, f"{subject_id}_{i:05d}.wav"),
+                        synthetic_segment(rng, duration, sample_rate, channels), sample_rate)
+
+
+def run(command, log_path):
+    """Runs a command; returns (wall seconds, peak RSS in MB of the largest process in its tree)."""
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=HERE, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 rather than wait: its rusage covers the child and the workers it reaped
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed, see {log_path}")
+    return time.perf_counter() - start, maxrss_mb(usage.ru_maxrss)
+
+
+def main():
+    args = parse_args()
+    data_dir = os.path.join(args.work_dir, "data")
+    settings = tree_settings(args)
+    settings_path = os.path.join(args.work_dir, "tree.json")
+
+    # the tree is reused across runs with the same settings, so results stay comparable
+    previous_settings = None
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            previous_settings = json.load(f)
+    if previous_settings != settings:
+        shutil.rmtree(data_dir, ignore_errors=True)
+        print(f"Generating {args.files} synthetic segments in {data_dir}")
+        generate_tree(data_dir, settings)
+        with open(settings_path, "w") as f:
+            json.dump(settings, f, indent=2)
+    python = sys.executable
+    run([python, "manifest.py", "--data_dir", os.path.abspath(data_dir)], os.path.join(args.work_dir, "manifest.log"))
+
+    # exports are named after the checkpoint they came from, built once up front and not timed
+    model_hash = hash_model(args.model_dir)[:12]
+    fill = {"batch_size": str(args.batch_size), "num_workers": str(args.num_workers),
+            "cache_dir": os.path.abspath(os.path.join(args.work_dir, "cache")),
+            "int8_model": os.path.abspath(os.path.join(args.work_dir, f"lid_int8_{model_hash}.pt")),
+            "int8_ts_model": os.path.abspath(os.path.join(args.work_dir, f"lid_int8_ts_{model_hash}.pt"))}
+    for mode, key, extra in (("int8", "int8_model", []), ("int8_torchscript", "int8_ts_model", ["--torchscript"])):
+        if mode in args.modes and not os.path.exists(fill[key]):
+            print(f"Exporting {fill[key]}")
+            run([python, "export_model.py", "--model_dir", os.path.abspath(args.model_dir), "--output", fill[key],
+                 "--quantize", "int8"] + extra, os.path.join(args.work_dir, f"export_{mode}.log"))
+    if "cache_cold" in args.modes:
+        shutil.rmtree(fill["cache_dir"], ignore_errors=True)
+
+    results = {}
+    for mode in args.modes:
+        output_dir = os.path.abspath(os.path.join(args.work_dir, "runs", mode))
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir)
+        command = [python, "baseline_inference.py", "--model_dir", os.path.abspath(args.model_dir),
+                   "--data_dir", os.path.abspath(data_dir), "--output_dir", output_dir, "--skip_manifest_update",
+                   "--profile_stages"] + [a.format(**fill) for a in MODES[mode]]
+        print(f"Running {mode}")
+        wall, peak_rss = run(command, os.path.join(output_dir, "log.txt"))
+        with open(os.path.join(output_dir, "stage_profile.json")) as f:
+            profile = json.load(f)
+        results[mode] = {
+            "wall_seconds": wall,
+            "files_per_second": profile["predicted"] / wall,
+            "inference_files_per_second": profile["files_per_second"],
+            "latency_ms": profile["latency_ms"],
+            "peak_rss_mb": peak_rss,
+            "profile": profile,
+        }
+
+    report = {"tree": settings, "machine": {"cpus": os.cpu_count(), "platform": platform.platform(),
+                                            "torch": torch.__version__},
+              "batch_size": args.batch_size, "num_workers": args.num_workers, "modes": results}
+    report_path = os.path.join(args.work_dir, "benchmark.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["modes"]
+    print(f"\n{'mode':<18}{'files/s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'peak MB':>9}")
+    for mode, result in results.items():
+        latency = result["latency_ms"]
+        line = (f"{mode:<18}{result['files_per_second']:9.2f}{latency.get('p50', float('nan')):9.0f}"
+                f"{latency.get('p90', float('nan')):9.0f}{latency.get('p99', float('nan')):9.0f}"
+                f"{result['peak_rss_mb']:9.0f}")
+        if previous and mode in previous:
+            line += f"   {result['files_per_second'] / previous[mode]['files_per_second']:.2f}x files/s vs --compare"
+        print(line)
+    print(f"Saved benchmark report to: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
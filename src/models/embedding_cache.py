@@ -0,0 +1,137 @@
+import os
+import time
+import hashlib
+import argparse
+
+import numpy as np
+
+# files that define the model's outputs, besides the label list; anything else in MODEL_DIR is ignored
+MODEL_FILES = ["hyperparams.yaml", "embedding_model.ckpt", "classifier.ckpt"]
+# from_hparams saves the label list as label_encoder.ckpt; the hub repo ships it as label_encoder.txt
+LABEL_ENCODER_FILES = ["label_encoder.ckpt", "label_encoder.txt"]
+
+
+def label_encoder_path(model_dir):
+    for name in LABEL_ENCODER_FILES:
+        path = os.path.join(model_dir, name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"{model_dir} has no {' or '.join(LABEL_ENCODER_FILES)}; "
+                            "download the model first (see README).")
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_model(model_dir):
+    # every file is required: a missing one would silently give a different model the same key
+    digest = hashlib.sha1()
+    for name in MODEL_FILES:
+        digest.update(name.encode())
+        digest.update(hash_file(os.path.join(model_dir, name)).encode())
+    # hashed under one name whichever copy exists, so .ckpt and .txt dirs share cache keys
+    digest.update(b"label_encoder.txt")
+    digest.update(hash_file(label_encoder_path(model_dir)).encode())
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """On-disk cache of per-file ECAPA embeddings and log-posteriors.
+
+    Entries live under <cache_dir>/<model_hash>/<xx>/<audio_hash>.npy as a
+    single float32 vector: the embedding followed by the log-posteriors.
+    The label list is stored once per model in labels.txt, so the cache can
+    be rescored without loading the model.
+    """
+
+    def __init__(self, cache_dir, model_hash):
+        self.model_hash = model_hash
+        self.model_dir = os.path.join(cache_dir, model_hash)
+        os.makedirs(self.model_dir, exist_ok=True)
+        self.labels = self.load_labels()
+
+    def _entry_path(self, audio_hash):
+        return os.path.join(self.model_dir, audio_hash[:2], audio_hash + ".npy")
+
+    def load_labels(self):
+        path = os.path.join(self.model_dir, "labels.txt")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return [line.rstrip("\n") for line in f]
+
+    def save_labels(self, labels):
+        if self.labels == labels:
+            return
+        path = os.path.join(self.model_dir, "labels.txt")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(labels) + "\n")
+        os.replace(tmp_path, path)
+        self.labels = list(labels)
+
+    def get(self, audio_hash):
+        path = self._entry_path(audio_hash)
+        if self.labels is None or not os.path.exists(path):
+            return None
+        vector = np.load(path, mmap_mode="r")
+        # touch on hit so size-based pruning evicts least recently used entries
+        os.utime(path)
+        num_classes = len(self.labels)
+        return vector[:-num_classes], vector[-num_classes:]
+
+    def put(self, audio_hash, embedding, log_probs):
+        path = self._entry_path(audio_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        vector = np.concatenate([np.asarray(embedding, dtype=np.float32).ravel(),
+                                 np.asarray(log_probs, dtype=np.float32).ravel()])
+        # write-then-rename so concurrent jobs never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, vector)
+        os.replace(tmp_path, path)
+
+
+def prune(cache_dir, max_bytes=None, max_age_days=None):
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith(".npy"):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+    removed = 0
+    if max_age_days is not None:
+        cutoff = time.time() - max_age_days * 86400
+        for entry in [e for e in entries if e[0] < cutoff]:
+            os.remove(entry[2])
+            removed += 1
+        entries = [e for e in entries if e[0] >= cutoff]
+
+    if max_bytes is not None:
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prune the embedding/log-posterior cache.")
+    parser.add_argument("--cache_dir", required=True)
+    parser.add_argument("--max_size_mb", type=float, default=None)
+    parser.add_argument("--max_age_days", type=float, default=None)
+    args = parser.parse_args()
+
+    max_bytes = int(args.max_size_mb * 1024 * 1024) if args.max_size_mb is not None else None
+    removed = prune(args.cache_dir, max_bytes=max_bytes, max_age_days=args.max_age_days)
+    print(f"Removed {removed} cache entries from {args.cache_dir}")
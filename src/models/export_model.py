@@ -0,0 +1,226 @@
+import os
+import copy
+import json
+import time
+import argparse
+from collections import defaultdict
+
+import torch
+import torchaudio
+from torch import nn
+
+from audio import SAMPLE_RATE
+from manifest import get_records
+from scoring import clean_label
+
+
+class LidPipeline(nn.Module):
+    """fbank -> sentence mean norm -> ECAPA -> classifier as one plain module.
+
+    Returns (embeddings, log_probs) for a padded batch, like encode_batch
+    followed by the classifier.
+    """
+
+    def __init__(self, mods):
+        super().__init__()
+        norm = mods.mean_var_norm
+        if norm.norm_type != "sentence" or norm.std_norm:
+            raise ValueError("Export only supports sentence-level mean normalisation without std_norm.")
+        self.compute_features = mods.compute_features
+        self.embedding_model = mods.embedding_model
+        self.classifier = mods.classifier
+
+    def forward(self, wavs, wav_lens):
+        feats = self.compute_features(wavs)
+        # InputNormalization(norm_type="sentence") loops over the batch in python; a masked mean
+        # does the same thing and traces
+        n_frames = feats.shape[1]
+        valid = torch.arange(n_frames, device=feats.device).unsqueeze(0) < torch.round(wav_lens * n_frames).unsqueeze(1)
+        valid = valid.unsqueeze(-1).to(feats.dtype)
+        feats = feats - (feats * valid).sum(dim=1, keepdim=True) / valid.sum(dim=1, keepdim=True)
+        embeddings = self.embedding_model(feats, wav_lens)
+        return embeddings.squeeze(1), self.classifier(embeddings).squeeze(1)
+
+
+class PointwiseLinear(nn.Module):
+    """A kernel-size-1 Conv1d rewritten as a Linear over channels, so dynamic quantization applies."""
+
+    def __init__(self, conv):
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data = conv.weight.data[:, :, 0].clone()
+        if conv.bias is not None:
+            self.linear.bias.data = conv.bias.data.clone()
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def convert_pointwise_convs(module):
+    # ~95% of ECAPA's conv weights are 1x1 (tdnn, SE, MFA); torch only quantizes Linear dynamically
+    for name, child in module.named_children():
+        if (isinstance(child, nn.Conv1d) and child.kernel_size == (1,) and child.stride == (1,)
+                and child.dilation == (1,) and child.groups == 1 and child.padding in ((0,), "valid", "same")):
+            setattr(module, name, PointwiseLinear(child))
+        else:
+            convert_pointwise_convs(child)
+    return module
+
+
+def quantize_int8(pipeline):
+    pipeline = convert_pointwise_convs(copy.deepcopy(pipeline))
+    return torch.ao.quantization.quantize_dynamic(pipeline, {nn.Linear}, dtype=torch.qint8)
+
+
+def trace(pipeline):
+    # ECAPA's length masks take the batch size from python len(), so the trace is made for
+    # (and used with) one utterance at a time; the time axis stays dynamic
+    example = (torch.randn(1, 3 * SAMPLE_RATE), torch.ones(1))
+    traced = torch.jit.trace(pipeline, example, check_trace=False)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+
+class ExportedModel:
+    """A single-file export loaded for inference; call with a padded batch like LidPipeline."""
+
+    def __init__(self, module, labels, batched):
+        self.module = module
+        self.labels = labels
+        self.batched = batched
+
+    def __call__(self, wavs, wav_lens):
+        with torch.no_grad():
+            if self.batched:
+                return self.module(wavs, wav_lens)
+            outputs = []
+            for wav, rel_len in zip(wavs, wav_lens):
+                length = int(round(rel_len.item() * wavs.shape[1]))
+                outputs.append(self.module(wav[:length].unsqueeze(0), torch.ones(1)))
+            return torch.cat([o[0] for o in outputs]), torch.cat([o[1] for o in outputs])
+
+
+def save_exported(module, labels, path, torchscript):
+    if torchscript:
+        torch.jit.save(module, path, _extra_files={"labels.json": json.dumps(labels)})
+    else:
+        torch.save({"model": module, "labels": labels}, path)
+
+
+def load_exported(path):
+    extra_files = {"labels.json": ""}
+    try:
+        module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        return ExportedModel(module, json.loads(extra_files["labels.json"]), batched=False)
+    except RuntimeError:
+        # not a TorchScript archive: a pickled eager module
+        bundle = torch.load(path, map_location="cpu", weights_only=False)
+        bundle["model"].eval()
+        return ExportedModel(bundle["model"], bundle["labels"], batched=True)
+
+
+def fp32_forward(model, wavs, wav_lens):
+    # the stock speechbrain path baseline_inference.py runs
+    embeddings = model.encode_batch(wavs, wav_lens)
+    return embeddings.squeeze(1), model.mods.classifier(embeddings).squeeze(1)
+
+
+def parity_report(exported, model, records):
+    """Top-1 agreement and per-corpus accuracy of the export against the fp32 model."""
+    agree = 0
+    max_diff = 0.0
+    timings = {"fp32": 0.0, "exported": 0.0}
+    correct = defaultdict(lambda: {"fp32": 0, "exported": 0, "total": 0})
+    for record in records:
+        try:
+            signal, fs = torchaudio.load(record["path"], channels_first=False)
+        except Exception as e:
+            print(f"Failed to process {record['path']}: {e}")
+            continue
+        wavs = model.audio_normalizer(signal, fs).unsqueeze(0)
+        wav_lens = torch.ones(1)
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            ref_prob = fp32_forward(model, wavs, wav_lens)[1][0]
+        timings["fp32"] += time.perf_counter() - start
+        start = time.perf_counter()
+        exp_prob = exported(wavs, wav_lens)[1][0]
+        timings["exported"] += time.perf_counter() - start
+
+        ref_idx, exp_idx = int(ref_prob.argmax()), int(exp_prob.argmax())
+        agree += ref_idx == exp_idx
+        max_diff = max(max_diff, (ref_prob - exp_prob).abs().max().item())
+        stats = correct[record["corpus"]]
+        stats["total"] += 1
+        stats["fp32"] += clean_label(exported.labels[ref_idx]) == record["true_lang"]
+        stats["exported"] += clean_label(exported.labels[exp_idx]) == record["true_lang"]
+
+    n_files = sum(s["total"] for s in correct.values())
+    per_corpus = {}
+    for corpus, stats in correct.items():
+        fp32_acc = stats["fp32"] / stats["total"]
+        exported_acc = stats["exported"] / stats["total"]
+        per_corpus[corpus] = {"files": stats["total"], "fp32_accuracy": fp32_acc,
+                              "exported_accuracy": exported_acc, "delta": exported_acc - fp32_acc}
+    return {
+        "files": n_files,
+        "top1_agreement": agree / n_files if n_files else float("nan"),
+        "max_abs_log_prob_diff": max_diff,
+        "fp32_seconds": timings["fp32"],
+        "exported_seconds": timings["exported"],
+        "speedup": timings["fp32"] / timings["exported"] if timings["exported"] else float("nan"),
+        "per_corpus": per_corpus,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export VoxLingua107 ECAPA to a CPU-optimized single file.")
+    parser.add_argument("--model_dir", required=True)
+    parser.add_argument("--output", required=True, help="exported model file, e.g. lid_int8.pt")
+    parser.add_argument("--quantize", choices=["none", "int8"], default="int8",
+                        help="dynamic int8 quantization of Linear and 1x1 conv layers")
+    parser.add_argument("--torchscript", action="store_true",
+                        help="trace and freeze the pipeline (runs one utterance at a time)")
+    parser.add_argument("--data_dir", default=None, help="held-out segments for the parity report")
+    parser.add_argument("--manifest", default=None)
+    parser.add_argument("--max_files", type=int, default=500,
+                        help="evenly spaced subset of the held-out set to compare on")
+    args = parser.parse_args()
+
+    # not at module level: baseline_inference.py imports this file and should not pull in speechbrain
+    from local_model import load_local_model
+    model = load_local_model(args.model_dir)
+    label_encoder = model.hparams.label_encoder
+    labels = [label_encoder.ind2lab[i] for i in range(len(label_encoder))]
+
+    module = LidPipeline(model.mods).eval()
+    if args.quantize == "int8":
+        module = quantize_int8(module)
+    if args.torchscript:
+        module = trace(module)
+    save_exported(module, labels, args.output, args.torchscript)
+    print(f"Saved {args.output} ({os.path.getsize(args.output) / 1e6:.1f} MB)")
+
+    if args.data_dir:
+        records = get_records(args.data_dir, args.manifest)
+        step = max(1, len(records) // args.max_files)
+        report = parity_report(load_exported(args.output), model, records[::step][:args.max_files])
+        report.update(artifact=os.path.basename(args.output), quantize=args.quantize, torchscript=args.torchscript,
+                      artifact_mb=os.path.getsize(args.output) / 1e6)
+        report_path = os.path.splitext(args.output)[0] + "_parity.json"
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        print(f"Top-1 agreement with fp32: {report['top1_agreement']:.2%} on {report['files']} files "
+              f"(max |log-prob diff| {report['max_abs_log_prob_diff']:.4f}), speedup {report['speedup']:.2f}x")
+        for corpus, stats in report["per_corpus"].items():
+            print(f"  {corpus}: fp32 {stats['fp32_accuracy']:.2%}, exported {stats['exported_accuracy']:.2%}, "
+                  f"delta {stats['delta']:+.2%}")
+        print(f"Saved parity report to: {report_path}")
+
+
+if __name__ == "__main__":
+    # run through the importable module so pickled exports reference export_model.LidPipeline,
+    # not __main__.LidPipeline
+    import export_model
+    export_model.main()
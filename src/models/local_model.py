@@ -0,0 +1,33 @@
+import os
+
+from hyperpyyaml import load_hyperpyyaml
+from speechbrain.inference.classifiers import EncoderClassifier
+from speechbrain.utils.checkpoints import torch_patched_state_dict_load
+
+from embedding_cache import LABEL_ENCODER_FILES, MODEL_FILES, label_encoder_path
+
+
+def load_local_model(model_dir):
+    """EncoderClassifier built from the files in MODEL_DIR only.
+
+    Same modules and weights as EncoderClassifier.from_hparams, but nothing
+    is resolved, fetched or symlinked, so it works on nodes without network.
+    """
+    missing = [name for name in MODEL_FILES if not os.path.exists(os.path.join(model_dir, name))]
+    if not any(os.path.exists(os.path.join(model_dir, name)) for name in LABEL_ENCODER_FILES):
+        missing.append(" or ".join(LABEL_ENCODER_FILES))
+    if missing:
+        raise FileNotFoundError(f"{model_dir} is missing {', '.join(missing)}; "
+                                "download the model first (see README).")
+
+    with open(os.path.join(model_dir, "hyperparams.yaml")) as f:
+        # the shipped yaml points pretrained_path at the hub id; point it at MODEL_DIR instead
+        hparams = load_hyperpyyaml(f, overrides={"pretrained_path": model_dir}, overrides_must_match=False)
+
+    for name in ("embedding_model", "classifier"):
+        path = os.path.join(model_dir, f"{name}.ckpt")
+        missing_keys, _ = hparams[name].load_state_dict(torch_patched_state_dict_load(path), strict=False)
+        if missing_keys:
+            raise ValueError(f"{path} has no weights for {', '.join(missing_keys)}.")
+    hparams["label_encoder"].load(label_encoder_path(model_dir))
+    return EncoderClassifier(modules=hparams["modules"], hparams=hparams)
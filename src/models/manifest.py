@@ -0,0 +1,192 @@
+import os
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from pathlib import Path
+
+import torchaudio
+
+MANIFEST_NAME = "manifest.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    duration REAL,
+    sample_rate INTEGER,
+    channels INTEGER,
+    subject TEXT,
+    corpus TEXT,
+    true_lang TEXT
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+"""
+
+
+def default_manifest_path(data_dir):
+    return os.path.join(data_dir, MANIFEST_NAME)
+
+
+def describe_file(file_path):
+    # subject/corpus/language are encoded in the segment tree layout
+    subject_id = Path(file_path).parts[-2]
+    corpus = Path(file_path).parts[-4] if "cslu_segments" in file_path else "shiro"
+    true_lang = "spanish" if corpus == "shiro" else "english"
+    return subject_id, corpus, true_lang
+
+
+def _connect(manifest_path):
+    conn = sqlite3.connect(manifest_path, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _file_row(data_dir, rel_dir, entry):
+    stat = entry.stat()
+    rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+    try:
+        info = torchaudio.info(entry.path)
+        duration = info.num_frames / info.sample_rate
+        sample_rate, channels = info.sample_rate, info.num_channels
+    except Exception as e:
+        print(f"Failed to read header of {entry.path}: {e}")
+        duration = sample_rate = channels = None
+    # describe the path as the old glob over DATA_DIR would have produced it
+    subject_id, corpus, true_lang = describe_file(f"{data_dir}/{rel_path}")
+    return (rel_path, rel_dir, stat.st_size, stat.st_mtime_ns, duration, sample_rate, channels,
+            subject_id, corpus, true_lang)
+
+
+def build_manifest(data_dir, manifest_path=None, full=False):
+    """Brings the index of every .wav under data_dir up to date.
+
+    Directories whose mtime has not changed since the last build are not
+    listed again (adding, removing or renaming a file changes it), so a
+    warm update costs one stat per directory. full=True re-stats every file,
+    which also picks up files rewritten in place.
+    Returns (files indexed, files whose header was read).
+    """
+    manifest_path = manifest_path or default_manifest_path(data_dir)
+    # sqlite locking is unreliable on network filesystems (Lustre/GPFS/NFS), and several jobs may
+    # update the same index: work on a local copy and rename it over the shared file, which is
+    # then never written in place. concurrent updates are each complete; the last one wins
+    fd, local_path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        if os.path.exists(manifest_path):
+            shutil.copyfile(manifest_path, local_path)
+        total, headers_read, changed = _update_manifest(data_dir, local_path, full)
+        if changed or not os.path.exists(manifest_path):
+            staged = f"{manifest_path}.{os.getpid()}.tmp"
+            shutil.copyfile(local_path, staged)
+            os.replace(staged, manifest_path)
+    finally:
+        os.remove(local_path)
+    return total, headers_read
+
+
+def _update_manifest(data_dir, manifest_path, full):
+    conn = _connect(manifest_path)
+    known_dirs = {path: (mtime_ns, subdirs)
+                  for path, mtime_ns, subdirs in conn.execute("SELECT path, mtime_ns, subdirs FROM dirs")}
+
+    seen_dirs = []
+    headers_read = 0
+    # only content changes are written back; a directory mtime bump alone (e.g. from this
+    # file being replaced) just costs one scandir next time
+    changed = False
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        seen_dirs.append(rel_dir)
+        abs_dir = os.path.join(data_dir, rel_dir)
+        mtime_ns = os.stat(abs_dir).st_mtime_ns
+
+        known = known_dirs.get(rel_dir)
+        if known is not None and known[0] == mtime_ns and not full:
+            stack.extend(os.path.join(rel_dir, d) if rel_dir else d for d in known[1].split("\n") if d)
+            continue
+
+        subdirs, wav_entries = [], []
+        with os.scandir(abs_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.name.endswith(".wav"):
+                    wav_entries.append(entry)
+
+        indexed = {path: (size, mtime) for path, size, mtime in
+                   conn.execute("SELECT path, size, mtime_ns FROM files WHERE dir = ?", (rel_dir,))}
+        current = set()
+        for entry in wav_entries:
+            rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+            current.add(rel_path)
+            stat = entry.stat()
+            if indexed.get(rel_path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         _file_row(data_dir, rel_dir, entry))
+            headers_read += 1
+        removed = [(p,) for p in indexed if p not in current]
+        conn.executemany("DELETE FROM files WHERE path = ?", removed)
+        subdir_list = "\n".join(sorted(subdirs))
+        changed = changed or bool(removed) or known is None or known[1] != subdir_list
+        conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (rel_dir, mtime_ns, subdir_list))
+        stack.extend(os.path.join(rel_dir, d) if rel_dir else d for d in subdirs)
+
+    # forget directories that disappeared, and the files in them
+    gone = set(known_dirs) - set(seen_dirs)
+    conn.executemany("DELETE FROM dirs WHERE path = ?", [(d,) for d in gone])
+    conn.executemany("DELETE FROM files WHERE dir = ?", [(d,) for d in gone])
+    conn.commit()
+    total = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    conn.close()
+    return total, headers_read, changed or headers_read > 0 or bool(gone)
+
+
+def load_manifest(data_dir, manifest_path=None):
+    """Returns one dict per indexed segment, skipping anything under an archive folder."""
+    manifest_path = manifest_path or default_manifest_path(data_dir)
+    # read-only and immutable: no locks on the shared file, which build_manifest only ever replaces
+    conn = sqlite3.connect(Path(manifest_path).absolute().as_uri() + "?mode=ro&immutable=1", uri=True)
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute("SELECT * FROM files ORDER BY path").fetchall()
+    conn.close()
+
+    records = []
+    for row in rows:
+        record = dict(row)
+        record["path"] = f"{data_dir}/{row['path']}"
+        if "archive" in record["path"].lower():
+            continue
+        records.append(record)
+    return records
+
+
+def get_records(data_dir, manifest_path=None, update=True):
+    if update or not os.path.exists(manifest_path or default_manifest_path(data_dir)):
+        total, headers_read = build_manifest(data_dir, manifest_path)
+        print(f"Manifest: {total} files indexed, {headers_read} new or changed")
+    records = load_manifest(data_dir, manifest_path)
+    if not records:
+        raise ValueError("No .wav files found in DATA_DIR. Check the folder structure.")
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the .wav index of a segment tree.")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--manifest", default=None, help=f"index file (default: DATA_DIR/{MANIFEST_NAME})")
+    parser.add_argument("--full", action="store_true", help="re-stat every file, not just changed directories")
+    args = parser.parse_args()
+
+    total, headers_read = build_manifest(args.data_dir, args.manifest, full=args.full)
+    print(f"Indexed {total} files ({headers_read} new or changed) in {args.manifest or default_manifest_path(args.data_dir)}")
@@ -0,0 +1,32 @@
+import os
+import argparse
+from glob import glob
+
+import pandas as pd
+
+from scoring import write_outputs
+
+# combine the per-shard predictions of a --num_shards run into the usual outputs
+parser = argparse.ArgumentParser()
+parser.add_argument("--output_dir", required=True,
+                    help="the --output_dir every shard wrote to")
+args = parser.parse_args()
+
+shard_files = sorted(glob(os.path.join(args.output_dir, "shards", "predictions_*_of_*.csv")))
+if not shard_files:
+    raise ValueError(f"No shard predictions found in {os.path.join(args.output_dir, 'shards')}.")
+
+num_shards = {int(shard_file.rsplit("_of_", 1)[1].split(".")[0]) for shard_file in shard_files}
+if len(num_shards) != 1:
+    raise ValueError(f"Shard files from runs with different --num_shards: {sorted(num_shards)}")
+num_shards = num_shards.pop()
+if len(shard_files) != num_shards:
+    print(f"Warning: only {len(shard_files)} of {num_shards} shards finished; merging what is there.")
+
+# read as strings so corpus ids like "00" survive the round trip
+shard_dfs = [pd.read_csv(f, dtype=str) for f in shard_files]
+pred_df = pd.concat(shard_dfs, ignore_index=True)
+pred_df["file_index"] = pred_df["file_index"].astype(int)
+pred_df = pred_df.sort_values("file_index").drop(columns="file_index")
+
+write_outputs(pred_df.to_dict("records"), args.output_dir)
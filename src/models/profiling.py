@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import resource
+from contextlib import contextmanager
+
+import numpy as np
+
+
+@contextmanager
+def timed(totals, stage):
+    """Adds the seconds spent in the block to totals[stage]; a no-op when totals is None."""
+    if totals is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        totals[stage] = totals.get(stage, 0.0) + time.perf_counter() - start
+
+
+def current_rss_mb():
+    # linux only; None elsewhere
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def maxrss_mb(ru_maxrss):
+    # getrusage/wait4 report kilobytes on linux, bytes on macOS
+    return ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def peak_rss_mb(children=False):
+    """Peak RSS of this process, or of its largest finished child process."""
+    return maxrss_mb(resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss)
+
+
+def latency_percentiles(seconds):
+    """p50/p90/p99/max in milliseconds."""
+    if not seconds:
+        return {}
+    values = np.asarray(seconds) * 1000
+    return {"p50": float(np.percentile(values, 50)), "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)), "max": float(values.max())}
@@ -0,0 +1,52 @@
+import os
+import argparse
+
+from embedding_cache import EmbeddingCache, hash_file, hash_model
+from manifest import get_records
+from scoring import prediction_row, write_outputs
+
+# rebuild every output csv from cached log-posteriors; no model is loaded
+parser = argparse.ArgumentParser()
+parser.add_argument("--data_dir", required=True)
+parser.add_argument("--cache_dir", required=True)
+parser.add_argument("--output_dir", required=True)
+parser.add_argument("--manifest", default=None,
+                    help="segment index to read/update (default: DATA_DIR/manifest.sqlite)")
+parser.add_argument("--model_dir", default=None,
+                    help="checkpoint the cache was filled with; only its files are hashed")
+parser.add_argument("--model_hash", default=None,
+                    help="cache key of the model, if the checkpoint is not available")
+args = parser.parse_args()
+
+os.makedirs(args.output_dir, exist_ok=True)
+
+if args.model_hash:
+    model_hash = args.model_hash
+elif args.model_dir:
+    model_hash = hash_model(args.model_dir)
+else:
+    cached_models = [d for d in os.listdir(args.cache_dir) if os.path.isdir(os.path.join(args.cache_dir, d))]
+    if len(cached_models) != 1:
+        raise ValueError("Cache holds several models; pass --model_dir or --model_hash.")
+    model_hash = cached_models[0]
+
+cache = EmbeddingCache(args.cache_dir, model_hash)
+if cache.labels is None:
+    raise ValueError(f"No labels.txt for model {model_hash} in {args.cache_dir}.")
+
+records = get_records(args.data_dir, args.manifest)
+
+predictions = []
+missing = 0
+for record in records:
+    cached = cache.get(hash_file(record["path"]))
+    if cached is None:
+        missing += 1
+        continue
+    predicted_lang = cache.labels[int(cached[1].argmax())]
+    predictions.append(prediction_row(record, predicted_lang))
+
+if missing:
+    print(f"{missing} files are not in the cache; run baseline_inference.py with --cache_dir to fill it.")
+
+write_outputs(predictions, args.output_dir)
@@ -0,0 +1,61 @@
+import os
+
+
+def prediction_row(record, predicted_lang):
+    # record is a manifest entry, see manifest.load_manifest
+    return {
+        "filename": record["subject"],
+        "file_path": record["path"],
+        "predicted_lang": predicted_lang,
+        "true_lang": record["true_lang"],
+        "corpus": record["corpus"]
+    }
+
+
+def clean_label(predicted_lang):
+    # "es: Spanish" -> "spanish"
+    return predicted_lang.split(":", 1)[-1].strip().lower() if isinstance(predicted_lang, str) else predicted_lang
+
+
+def write_outputs(predictions, output_dir):
+    # imported here so inference jobs only load pandas/sklearn once they reach scoring
+    import pandas as pd
+    from sklearn.metrics import precision_recall_fscore_support
+
+    # save predictions
+    pred_df = pd.DataFrame(predictions)
+    if pred_df.empty:
+        raise ValueError("Prediction dataframe is empty. No predictions were made.")
+
+    pred_df["filename"] = pred_df["filename"].str.lower()
+    pred_df.to_csv(os.path.join(output_dir, "predictions.csv"), index=False)
+
+    # corpus accuracy
+    for corpus_name in pred_df["corpus"].unique():
+        corpus_df = pred_df[pred_df["corpus"] == corpus_name].copy()
+        print(f"\n=== Results for {corpus_name.upper()} ===")
+
+        corpus_df["predicted_lang_clean"] = corpus_df["predicted_lang"].apply(clean_label)
+        corpus_df["correct"] = corpus_df["predicted_lang_clean"] == corpus_df["true_lang"].str.lower()
+
+        subject_acc_df = (corpus_df.groupby("filename", sort=False)["correct"].mean()
+                          .rename("accuracy").reset_index())
+        mean_acc = subject_acc_df["accuracy"].mean()
+        std_acc = subject_acc_df["accuracy"].std()
+
+        subject_acc_df.to_csv(os.path.join(output_dir, f"per_subject_accuracy_{corpus_name}.csv"), index=False)
+
+        overall_acc = corpus_df["correct"].mean()
+        y_true = corpus_df["true_lang"].str.lower()
+        y_pred = corpus_df["predicted_lang_clean"]
+        precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, average="macro", zero_division=0)
+
+        print(f"Overall Accuracy: {overall_acc:.2%}")
+        print(f"Mean Per-Subject Accuracy: {mean_acc:.2%} ± {std_acc:.2%}")
+        print(f"Precision: {precision:.4f}, Recall: {recall:.4f}, F1: {f1:.4f}")
+
+    pred_df["predicted_lang_clean"] = pred_df["predicted_lang"].str.extract(r":\s*(.*)", expand=False).str.lower().str.strip()
+    mismatches = pred_df[pred_df["predicted_lang_clean"] != pred_df["true_lang"].str.lower()]
+    mismatches.to_csv(os.path.join(output_dir, "mismatched_predictions.csv"), index=False)
+    print(f"Saved predictions to: {os.path.join(output_dir, 'predictions.csv')}")
+    return pred_df
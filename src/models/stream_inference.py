@@ -0,0 +1,360 @@
+import os
+import csv
+import copy
+import math
+import argparse
+import multiprocessing as mp
+from collections import defaultdict
+
+import torch
+import torchaudio
+
+from audio import SAMPLE_RATE, get_resampler, set_worker_threads
+
+AUDIO_EXTENSIONS = (".wav", ".flac")
+
+_model = None
+_model_dir = None
+_int8 = False
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Language segments of long recordings, read and scored in a stream.")
+    parser.add_argument("--model_dir", required=True)
+    parser.add_argument("--input", required=True, nargs="+", help="long recordings, or directories to search for them")
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--window", type=float, default=3.0, help="seconds of audio per scored window")
+    parser.add_argument("--hop", type=float, default=1.0, help="seconds between window starts")
+    parser.add_argument("--chunk", type=float, default=30.0,
+                        help="seconds of audio read and featurized at a time; bounds memory")
+    parser.add_argument("--energy_threshold", type=float, default=-45.0,
+                        help="frames below this level (dBFS) count as silence")
+    parser.add_argument("--min_speech_ratio", type=float, default=0.3,
+                        help="windows with a smaller share of non-silent frames are not scored")
+    parser.add_argument("--batch_size", type=int, default=8, help="windows per forward pass")
+    parser.add_argument("--int8", action="store_true",
+                        help="dynamic int8 ECAPA and classifier, as export_model.py --quantize int8")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="recordings processed in parallel, each worker with its own copy of the model")
+    parser.add_argument("--torch_threads", type=int, default=None,
+                        help="intra-op threads per worker (default: cores / num_workers)")
+    return parser.parse_args()
+
+
+def init_worker(model_dir, torch_threads, int8=False):
+    global _model_dir, _int8
+    _model_dir = model_dir
+    _int8 = int8
+    set_worker_threads(torch_threads)
+
+
+def get_model():
+    global _model
+    if _model is None:
+        from local_model import load_local_model
+        _model = load_local_model(_model_dir)
+        if _int8:
+            from export_model import quantize_int8
+            _model.mods.embedding_model = quantize_int8(_model.mods.embedding_model)
+            _model.mods.classifier = quantize_int8(_model.mods.classifier)
+    return _model
+
+
+def find_recordings(inputs):
+    recordings = []
+    for path in inputs:
+        if os.path.isfile(path):
+            recordings.append((path, os.path.splitext(os.path.basename(path))[0]))
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    file_path = os.path.join(root, name)
+                    recordings.append((file_path, os.path.splitext(os.path.relpath(file_path, path))[0]))
+    return recordings
+
+
+def read_blocks(path, chunk_seconds):
+    """Yields the recording as consecutive 16 kHz mono blocks, never decoding more than one chunk at once.
+
+    Each chunk is resampled with enough neighbouring input around it that the
+    blocks join up to exactly what resampling the whole file would give.
+    """
+    info = torchaudio.info(path)
+    sample_rate, total = info.sample_rate, info.num_frames
+    if sample_rate == SAMPLE_RATE:
+        step = max(1, int(chunk_seconds * sample_rate))
+        for offset in range(0, total, step):
+            signal, _ = torchaudio.load(path, frame_offset=offset, num_frames=step, channels_first=False)
+            yield signal.mean(dim=1)
+        return
+
+    # the resampler works in blocks of in_unit input / out_unit output samples; chunks start on
+    # a block and carry `margin` samples of context (>= kernel width) on either side
+    resampler = get_resampler(sample_rate)
+    gcd = math.gcd(sample_rate, SAMPLE_RATE)
+    in_unit, out_unit = sample_rate // gcd, SAMPLE_RATE // gcd
+    margin = in_unit * (math.ceil(resampler.width / in_unit) + 1)
+    step = in_unit * max(1, int(chunk_seconds * sample_rate) // in_unit)
+    for offset in range(0, total, step):
+        start, end = max(0, offset - margin), min(total, offset + step)
+        signal, _ = torchaudio.load(path, frame_offset=start, num_frames=min(total, end + margin) - start,
+                                    channels_first=False)
+        resampled = resampler(signal.transpose(0, 1)).transpose(0, 1)
+        skip = (offset - start) // in_unit * out_unit
+        yield resampled[skip:skip + math.ceil((end - offset) * out_unit / in_unit)].mean(dim=1)
+
+
+def stream_features(blocks, compute_features, n_fft, hop):
+    """Yields (fbank frames, frame energies in dBFS) for a stream of 16 kHz blocks.
+
+    Frame k is centered on sample k * hop as in one fbank over the whole
+    recording; every sample is featurized once, with a couple of hops of
+    context carried over from the previous block so no frame is cut short.
+    """
+    context = -(-(n_fft // 2) // hop) * hop
+    # zeros before the first sample, like center=True padding
+    buf, buf_start = torch.zeros(context), -context
+    next_frame = n_samples = 0
+    for block in blocks:
+        buf = torch.cat([buf, block])
+        n_samples += block.shape[0]
+        # frames whose right-hand context has been read
+        ready = (buf_start + buf.shape[0] - context) // hop + 1
+        yield from _featurize(buf, buf_start, next_frame, ready, compute_features, hop, context)
+        next_frame = max(next_frame, ready)
+        keep_from = next_frame * hop - context - buf_start
+        buf, buf_start = buf[keep_from:], buf_start + keep_from
+    # zeros after the last sample; the last frame is centered on or before it
+    buf = torch.cat([buf, torch.zeros(context)])
+    yield from _featurize(buf, buf_start, next_frame, n_samples // hop + 1, compute_features, hop, context)
+
+
+def _featurize(buf, buf_start, first_frame, end_frame, compute_features, hop, context):
+    if end_frame <= first_frame:
+        return
+    n_frames = end_frame - first_frame
+    start = first_frame * hop - context - buf_start
+    segment = buf[start:start + (n_frames - 1) * hop + 2 * context]
+    with torch.no_grad():
+        feats = compute_features(segment.unsqueeze(0))[0]
+    frames = segment[context - hop // 2:context - hop // 2 + n_frames * hop].view(n_frames, hop)
+    energy = 10 * torch.log10(frames.pow(2).mean(dim=1) + 1e-10)
+    yield feats[context // hop:context // hop + n_frames], energy
+
+
+def stream_windows(frame_stream, window_frames, hop_frames):
+    """Yields (first_frame, feats, energy) for overlapping windows, slicing the shared frames.
+
+    The last window is aligned to the end of the recording; a recording
+    shorter than one window is a single window.
+    """
+    feats_buf, energy_buf = None, None
+    buf_first = next_start = 0
+    for feats, energy in frame_stream:
+        feats_buf = feats if feats_buf is None else torch.cat([feats_buf, feats])
+        energy_buf = energy if energy_buf is None else torch.cat([energy_buf, energy])
+        while next_start + window_frames <= buf_first + feats_buf.shape[0]:
+            i = next_start - buf_first
+            yield next_start, feats_buf[i:i + window_frames], energy_buf[i:i + window_frames]
+            next_start += hop_frames
+        # drop frames no later window needs (the tail window may start as early as the last one)
+        drop = min(max(0, next_start - hop_frames - buf_first), feats_buf.shape[0])
+        feats_buf, energy_buf, buf_first = feats_buf[drop:], energy_buf[drop:], buf_first + drop
+
+    if feats_buf is None:
+        return
+    n_frames = buf_first + feats_buf.shape[0]
+    last_emitted_end = next_start - hop_frames + window_frames if next_start > 0 else 0
+    if last_emitted_end < n_frames:
+        i = max(0, n_frames - window_frames) - buf_first
+        yield buf_first + i, feats_buf[i:], energy_buf[i:]
+
+
+def classify_windows(model, feats, top_db):
+    """Log-posteriors for a batch of equal-length windows of (unclipped) fbank frames."""
+    lens = torch.ones(feats.shape[0])
+    with torch.no_grad():
+        # Fbank floors each utterance at top_db below its loudest value; do the same per window
+        feats = torch.max(feats, feats.amax(dim=(1, 2), keepdim=True) - top_db)
+        feats = model.mods.mean_var_norm(feats, lens)
+        embeddings = model.mods.embedding_model(feats, lens)
+        return model.mods.classifier(embeddings).squeeze(1)
+
+
+def merge_windows(windows, frame_seconds):
+    """Consecutive scored windows with the same top language -> time-stamped segments.
+
+    Neighbouring windows with different languages are split at the middle of
+    their overlap. A silent (unscored) window ends the current segment where
+    that window begins, and segments never overlap.
+    """
+    segments = []
+    current = None
+    prev_end = None
+    last_end = 0.0
+    for start_frame, n_frames, label, log_prob in windows:
+        start, end = start_frame * frame_seconds, (start_frame + n_frames - 1) * frame_seconds
+        if label is None:
+            if current is not None:
+                # the silent window's span is not speech, so don't run the segment into it
+                current["end"] = max(current["start"], min(current["end"], start))
+                last_end = current["end"]
+                segments.append(current)
+            current = prev_end = None
+            continue
+        if current is not None and label == current["predicted_lang"]:
+            current["end"] = end
+            current["log_prob_sum"] += log_prob
+            current["windows"] += 1
+        else:
+            boundary = max(start, last_end)
+            if current is not None:
+                boundary = (start + prev_end) / 2
+                current["end"] = boundary
+                segments.append(current)
+            current = {"start": boundary, "end": end, "predicted_lang": label, "log_prob_sum": log_prob, "windows": 1}
+        prev_end = end
+    if current is not None:
+        segments.append(current)
+    return segments
+
+
+def stream_recording(job):
+    """Streams one recording; returns (segments, summary) or raises on unreadable audio."""
+    path, recording, args = job
+    model = get_model()
+    label_encoder = model.hparams.label_encoder
+    labels = [label_encoder.ind2lab[i] for i in range(len(label_encoder))]
+    compute_features = model.mods.compute_features
+    if compute_features.deltas or compute_features.context:
+        raise ValueError("Streaming only supports plain fbank features (no deltas or context frames).")
+    # frames are shared between windows, so they are computed without the per-utterance dB floor
+    raw_features = copy.deepcopy(compute_features)
+    raw_features.compute_fbanks.top_db = math.inf
+    top_db = compute_features.compute_fbanks.top_db
+    stft = compute_features.compute_STFT
+    hop = stft.hop_length
+    frame_seconds = hop / SAMPLE_RATE
+    window_frames = int(round(args.window * SAMPLE_RATE)) // hop + 1
+    hop_frames = max(1, int(round(args.hop * SAMPLE_RATE)) // hop)
+
+    frames = stream_features(read_blocks(path, args.chunk), raw_features, stft.n_fft, hop)
+    windows = []
+    batch, batch_starts = [], []
+
+    def flush():
+        log_probs = classify_windows(model, torch.stack(batch), top_db)
+        for start_frame, feats, row in zip(batch_starts, batch, log_probs):
+            best = int(row.argmax())
+            windows.append((start_frame, feats.shape[0], labels[best], row[best].item()))
+        batch.clear()
+        batch_starts.clear()
+
+    n_windows = 0
+    for start_frame, feats, energy in stream_windows(frames, window_frames, hop_frames):
+        n_windows += 1
+        if (energy > args.energy_threshold).float().mean().item() < args.min_speech_ratio:
+            if batch:
+                flush()
+            windows.append((start_frame, feats.shape[0], None, None))
+            continue
+        # only equal-length windows share a batch, so none is padded
+        if batch and (len(batch) == args.batch_size or feats.shape[0] != batch[0].shape[0]):
+            flush()
+        batch.append(feats)
+        batch_starts.append(start_frame)
+    if batch:
+        flush()
+
+    segments = merge_windows(windows, frame_seconds)
+    info = torchaudio.info(path)
+    duration = info.num_frames / info.sample_rate
+    language_seconds = defaultdict(float)
+    for segment in segments:
+        segment["recording"] = recording
+        segment["mean_log_prob"] = segment.pop("log_prob_sum") / segment["windows"]
+        language_seconds[segment["predicted_lang"]] += segment["end"] - segment["start"]
+    speech_seconds = sum(language_seconds.values())
+    top_lang = max(language_seconds, key=language_seconds.get) if language_seconds else None
+    summary = {
+        "recording": recording,
+        "file_path": path,
+        "duration": duration,
+        "speech_seconds": speech_seconds,
+        "windows": n_windows,
+        "scored_windows": sum(1 for w in windows if w[2] is not None),
+        "top_lang": top_lang,
+        "top_lang_share": language_seconds[top_lang] / speech_seconds if top_lang else 0.0,
+        "languages": dict(sorted(language_seconds.items(), key=lambda kv: -kv[1])),
+    }
+    return segments, summary
+
+
+def safe_stream_recording(job):
+    try:
+        return stream_recording(job), None
+    except Exception as e:
+        return None, f"Failed to process {job[0]}: {e}"
+
+
+def run_recordings(jobs, args):
+    if args.num_workers <= 1:
+        yield from map(safe_stream_recording, jobs)
+        return
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(args.num_workers, initializer=init_worker,
+                  initargs=(args.model_dir, args.torch_threads, args.int8)) as pool:
+        yield from pool.imap(safe_stream_recording, jobs)
+
+
+def main():
+    args = parse_args()
+    if args.hop <= 0 or args.window < args.hop:
+        raise ValueError("Need 0 < --hop <= --window.")
+    if args.num_workers > 1 and args.torch_threads is None:
+        args.torch_threads = max(1, (os.cpu_count() or 1) // args.num_workers)
+    os.makedirs(args.output_dir, exist_ok=True)
+    init_worker(args.model_dir, args.torch_threads, args.int8)
+
+    recordings = find_recordings(args.input)
+    print(f"{len(recordings)} recordings")
+    jobs = [(path, recording, args) for path, recording in recordings]
+
+    segments_path = os.path.join(args.output_dir, "segments.csv")
+    summary_path = os.path.join(args.output_dir, "recording_summary.csv")
+    languages_path = os.path.join(args.output_dir, "recording_languages.csv")
+    # rows are written as each recording finishes, so nothing accumulates across recordings
+    with open(segments_path, "w", newline="") as seg_f, open(summary_path, "w", newline="") as sum_f, \
+            open(languages_path, "w", newline="") as lang_f:
+        seg_writer = csv.DictWriter(seg_f, ["recording", "start", "end", "predicted_lang", "mean_log_prob",
+                                            "windows"])
+        sum_writer = csv.DictWriter(sum_f, ["recording", "file_path", "duration", "speech_seconds", "windows",
+                                            "scored_windows", "top_lang", "top_lang_share"])
+        lang_writer = csv.DictWriter(lang_f, ["recording", "predicted_lang", "seconds", "share"])
+        for writer in (seg_writer, sum_writer, lang_writer):
+            writer.writeheader()
+
+        for result, error in run_recordings(jobs, args):
+            if error:
+                print(error)
+                continue
+            segments, summary = result
+            for segment in segments:
+                seg_writer.writerow({k: round(v, 3) if isinstance(v, float) else v for k, v in segment.items()})
+            languages = summary.pop("languages")
+            sum_writer.writerow({k: round(v, 3) if isinstance(v, float) else v for k, v in summary.items()})
+            for lang, seconds in languages.items():
+                lang_writer.writerow({"recording": summary["recording"], "predicted_lang": lang,
+                                      "seconds": round(seconds, 3),
+                                      "share": round(seconds / summary["speech_seconds"], 3)})
+            print(f"{summary['recording']}: {summary['duration']:.1f}s, {summary['speech_seconds']:.1f}s of speech "
+                  f"in {len(segments)} segments, mostly {summary['top_lang']}")
+
+    print(f"Saved segments to: {segments_path}")
+    print(f"Saved recording summaries to: {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
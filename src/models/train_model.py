@@ -1,3 +1,299 @@
+import os
+import json
+import time
+import zlib
+import argparse
+
+import numpy as np
+import torch
 import torchaudio
-from speechbrain.inference.classifiers import EncoderClassifier
-language_id = EncoderClassifier.from_hparams(source="speechbrain/lang-id-voxlingua107-ecapa", savedir="tmp")
\ No newline at end of file
+from torch import nn
+from torch.nn.utils.parametrizations import orthogonal
+from torch.utils.data import DataLoader, Dataset
+
+from audio import SAMPLE_RATE
+from augment_data import PITCH_SHIFTS, SPEED_FACTORS, pitch_shift, speed_perturb, variant_grid
+from local_model import load_local_model
+from manifest import get_records
+from scoring import clean_label
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fine-tune VoxLingua107 ECAPA on child speech segments.")
+    parser.add_argument("--model_dir", required=True)
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--manifest", default=None,
+                        help="segment index to read/update (default: DATA_DIR/manifest.sqlite)")
+    parser.add_argument("--feature_store", default=None,
+                        help="memory-mapped waveform/fbank store (default: OUTPUT_DIR/feature_store)")
+    # Prasad et al. (2024): orthonormal linear head, lr 3e-5, batch size 8
+    parser.add_argument("--lr", type=float, default=3e-5)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--num_workers", type=int, default=4,
+                        help="dataloader processes doing the on-the-fly perturbation")
+    parser.add_argument("--speed_factors", type=float, nargs="*", default=SPEED_FACTORS)
+    parser.add_argument("--pitch_shifts", type=int, nargs="*", default=PITCH_SHIFTS)
+    parser.add_argument("--valid_fraction", type=float, default=0.1,
+                        help="share of subjects held out for validation (un-augmented)")
+    return parser.parse_args()
+
+
+class FeatureStore:
+    """Original segments decoded once into flat float32 memmaps.
+
+    waveforms.f32 holds every 16 kHz mono waveform back to back and
+    features.f32 the matching fbank frames; index.npy has one row of
+    (wav_start, wav_len, feat_start, feat_len) per item, and keys.json every
+    record the build attempted, including any that failed. Augmented items are
+    perturbed from the stored waveform, un-augmented ones read the stored
+    features directly.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._waveforms = None
+        self._features = None
+        self.index = np.load(os.path.join(store_dir, "index.npy"))
+        with open(os.path.join(store_dir, "items.json")) as f:
+            self.items = json.load(f)
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.n_mels = json.load(f)["n_mels"]
+
+    def __len__(self):
+        return len(self.index)
+
+    @staticmethod
+    def item_keys(records):
+        return [[r["path"], r["size"], r["mtime_ns"]] for r in records]
+
+    @staticmethod
+    def is_current(store_dir, records):
+        # compared against every record the build attempted, so files that failed to decode
+        # don't make the store look stale on every run
+        keys_path = os.path.join(store_dir, "keys.json")
+        if not os.path.exists(keys_path):
+            return False
+        with open(keys_path) as f:
+            return json.load(f) == FeatureStore.item_keys(records)
+
+    @staticmethod
+    def build(store_dir, records, model):
+        os.makedirs(store_dir, exist_ok=True)
+        index, items = [], []
+        wav_offset = feat_offset = 0
+        n_mels = None
+        with open(os.path.join(store_dir, "waveforms.f32"), "wb") as wav_file, \
+                open(os.path.join(store_dir, "features.f32"), "wb") as feat_file:
+            for record, key in zip(records, FeatureStore.item_keys(records)):
+                try:
+                    signal, fs = torchaudio.load(record["path"], channels_first=False)
+                    signal = model.audio_normalizer(signal, fs)
+                    with torch.no_grad():
+                        feats = model.mods.compute_features(signal.unsqueeze(0))[0]
+                except Exception as e:
+                    print(f"Failed to process {record['path']}: {e}")
+                    continue
+                n_mels = feats.shape[1]
+                wav_file.write(signal.numpy().astype(np.float32).tobytes())
+                feat_file.write(feats.numpy().astype(np.float32).tobytes())
+                index.append((wav_offset, signal.shape[0], feat_offset, feats.shape[0]))
+                wav_offset += signal.shape[0]
+                feat_offset += feats.shape[0]
+                items.append({"key": key, "subject": record["subject"], "corpus": record["corpus"],
+                              "true_lang": record["true_lang"]})
+        np.save(os.path.join(store_dir, "index.npy"), np.asarray(index, dtype=np.int64).reshape(-1, 4))
+        with open(os.path.join(store_dir, "meta.json"), "w") as f:
+            json.dump({"n_mels": n_mels, "sample_rate": SAMPLE_RATE}, f)
+        with open(os.path.join(store_dir, "items.json"), "w") as f:
+            json.dump(items, f)
+        # written last: a store without keys.json is treated as incomplete
+        with open(os.path.join(store_dir, "keys.json"), "w") as f:
+            json.dump(FeatureStore.item_keys(records), f)
+
+    def _open(self):
+        # opened lazily so each dataloader worker maps the files itself
+        if self._waveforms is None:
+            self._waveforms = np.memmap(os.path.join(self.store_dir, "waveforms.f32"), dtype=np.float32, mode="r")
+            self._features = np.memmap(os.path.join(self.store_dir, "features.f32"), dtype=np.float32, mode="r")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_waveforms"] = state["_features"] = None
+        return state
+
+    def waveform(self, i):
+        self._open()
+        start, length = self.index[i, 0], self.index[i, 1]
+        return torch.from_numpy(np.array(self._waveforms[start:start + length]))
+
+    def features(self, i):
+        self._open()
+        start, length = self.index[i, 2], self.index[i, 3]
+        return torch.from_numpy(np.array(self._features[start * self.n_mels:(start + length) * self.n_mels])
+                                ).view(length, self.n_mels)
+
+
+class StreamingAugmentDataset(Dataset):
+    """Every (segment, variant) pair of the augmentation grid, perturbed on the fly.
+
+    Same items as the directory augment_data.py writes, without writing it.
+    """
+
+    def __init__(self, store, item_ids, label_ids, variants, compute_features):
+        self.store = store
+        self.item_ids = item_ids
+        self.label_ids = label_ids
+        self.variants = variants
+        self.compute_features = compute_features
+
+    def __len__(self):
+        return len(self.item_ids) * len(self.variants)
+
+    def __getitem__(self, idx):
+        item, variant = divmod(idx, len(self.variants))
+        item_id = self.item_ids[item]
+        speed, pitch = self.variants[variant]
+        label = self.label_ids[self.store.items[item_id]["true_lang"].lower()]
+        if speed is None:
+            return self.store.features(item_id), label
+
+        waveform = speed_perturb(self.store.waveform(item_id).unsqueeze(0), SAMPLE_RATE, speed)
+        if pitch is not None:
+            waveform = pitch_shift(waveform, SAMPLE_RATE, pitch)
+        with torch.no_grad():
+            feats = self.compute_features(waveform)[0]
+        return feats, label
+
+
+def collate(batch):
+    feats = [f for f, _ in batch]
+    lengths = torch.tensor([f.shape[0] for f in feats], dtype=torch.float)
+    padded = torch.nn.utils.rnn.pad_sequence(feats, batch_first=True)
+    return padded, lengths / lengths.max(), torch.tensor([label for _, label in batch])
+
+
+class OrthonormalHead(nn.Module):
+    """Linear layer whose weight rows are kept orthonormal, on top of the ECAPA embedding."""
+
+    def __init__(self, input_size, n_classes):
+        super().__init__()
+        self.linear = orthogonal(nn.Linear(input_size, n_classes, bias=False))
+
+    def forward(self, embeddings):
+        return torch.log_softmax(self.linear(embeddings), dim=-1)
+
+
+def split_items(store, valid_fraction):
+    # hold out whole subjects so validation speakers are never seen in training
+    train_ids, valid_ids = [], []
+    for i, item in enumerate(store.items):
+        bucket = zlib.crc32(f"{item['corpus']}/{item['subject']}".encode()) % 1000
+        (valid_ids if bucket < valid_fraction * 1000 else train_ids).append(i)
+    return train_ids, valid_ids
+
+
+def forward(model, head, feats, lens):
+    feats = model.mods.mean_var_norm(feats, lens)
+    embeddings = model.mods.embedding_model(feats, lens).squeeze(1)
+    return head(embeddings)
+
+
+def evaluate(model, head, loader):
+    model.mods.embedding_model.eval()
+    head.eval()
+    correct = total = 0
+    with torch.no_grad():
+        for feats, lens, labels in loader:
+            predictions = forward(model, head, feats, lens).argmax(dim=-1)
+            correct += (predictions == labels).sum().item()
+            total += len(labels)
+    return correct / total if total else float("nan")
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    store_dir = args.feature_store or os.path.join(args.output_dir, "feature_store")
+
+    model = load_local_model(args.model_dir)
+
+    records = get_records(args.data_dir, args.manifest)
+    if not FeatureStore.is_current(store_dir, records):
+        print(f"Building feature store for {len(records)} segments in {store_dir}")
+        FeatureStore.build(store_dir, records, model)
+    store = FeatureStore(store_dir)
+    if not len(store):
+        raise ValueError(f"None of the {len(records)} segments in {args.data_dir} could be decoded; "
+                         "see the errors printed while building the feature store.")
+
+    # keep the pretrained 107-way label space: a Spanish-only corpus is still a real classification
+    # problem, and the fine-tuned head's outputs line up with the stock model's labels
+    label_encoder = model.hparams.label_encoder
+    languages = [label_encoder.ind2lab[i] for i in range(len(label_encoder))]
+    label_ids = {clean_label(lang): i for i, lang in enumerate(languages)}
+    data_languages = sorted({item["true_lang"].lower() for item in store.items})
+    unknown = [lang for lang in data_languages if lang not in label_ids]
+    if unknown:
+        raise ValueError(f"true_lang {', '.join(unknown)} is not one of the model's {len(languages)} languages.")
+    train_ids, valid_ids = split_items(store, args.valid_fraction)
+    if not train_ids:
+        raise ValueError(f"No training segments: all {len(store)} segments from {args.data_dir} fall in the "
+                         f"validation subjects (--valid_fraction {args.valid_fraction}). "
+                         "Add subjects or lower --valid_fraction.")
+    variants = variant_grid(args.speed_factors, args.pitch_shifts)
+    print(f"{len(train_ids)} training segments x {len(variants)} variants, "
+          f"{len(valid_ids)} validation segments, languages in data: {data_languages} "
+          f"(head keeps all {len(languages)})")
+
+    compute_features = model.mods.compute_features
+    train_set = StreamingAugmentDataset(store, train_ids, label_ids, variants, compute_features)
+    valid_set = StreamingAugmentDataset(store, valid_ids, label_ids, [(None, None)], compute_features)
+    loader_kwargs = dict(batch_size=args.batch_size, collate_fn=collate, num_workers=args.num_workers)
+    if args.num_workers > 0:
+        # dataloader workers already run with one intra-op thread each
+        loader_kwargs.update(persistent_workers=True)
+    train_loader = DataLoader(train_set, shuffle=True, **loader_kwargs)
+    valid_loader = DataLoader(valid_set, shuffle=False, **loader_kwargs)
+
+    with torch.no_grad():
+        embedding_size = model.mods.embedding_model(store.features(0).unsqueeze(0)).shape[-1]
+    head = OrthonormalHead(embedding_size, len(languages))
+    params = list(model.mods.embedding_model.parameters()) + list(head.parameters())
+    for param in params:
+        param.requires_grad = True
+    optimizer = torch.optim.Adam(params, lr=args.lr)
+    loss_fn = nn.NLLLoss()
+
+    best_acc = -1.0
+    for epoch in range(1, args.epochs + 1):
+        model.mods.embedding_model.train()
+        head.train()
+        start = time.time()
+        total_loss, steps = 0.0, 0
+        for feats, lens, labels in train_loader:
+            optimizer.zero_grad()
+            loss = loss_fn(forward(model, head, feats, lens), labels)
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()
+            steps += 1
+
+        valid_acc = evaluate(model, head, valid_loader) if valid_ids else float("nan")
+        print(f"Epoch {epoch}: loss {total_loss / max(steps, 1):.4f}, "
+              f"valid accuracy {valid_acc:.2%}, {time.time() - start:.1f}s")
+
+        if not valid_ids or valid_acc > best_acc:
+            best_acc = valid_acc
+            torch.save({
+                "embedding_model": model.mods.embedding_model.state_dict(),
+                "head": head.state_dict(),
+                "languages": languages,
+                "epoch": epoch,
+                "valid_accuracy": valid_acc,
+            }, os.path.join(args.output_dir, "fine_tuned.ckpt"))
+
+
+if __name__ == "__main__":
+    main()